@@ -3,6 +3,21 @@ import requests
 import json
 import sys
 
+SHIP_TTL = 7 * 86400    # ship run state expires after a week
+
+# move the recipient from its previous status counter to the new one,
+# so retries do not count twice
+TRACK = """
+local old = redis.call('HGET', KEYS[2], ARGV[1])
+if old ~= ARGV[2] then
+  if old then redis.call('HINCRBY', KEYS[1], old, -1) end
+  redis.call('HINCRBY', KEYS[1], ARGV[2], 1)
+  redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+"""
+
 #%%
 def send(url, key, msg):
     hdr = {"Ocp-Apim-Subscription-Key": key}
@@ -12,6 +27,78 @@ def send(url, key, msg):
         return {"body": json.loads(r.text) }
     return { "body": {"error": r.text}}
 
+#%%
+def extra(rec):
+    res = {}
+    if "amount" in rec and rec["amount"] != "":
+        try:
+            amount = int(rec["amount"])
+            pd = {
+                "amount": amount,
+                "notice_number": "000000000000000001",
+            }
+            if "notice_number" in rec:
+                pd["notice_number"] = ("000000000000000000" + str(rec["notice_number"]))[-18:]
+            if "due_date" in rec and rec["due_date"] !="" :
+                res["due_date"] = rec["due_date"]
+                if "invalid_after_due_date" in rec and rec["invalid_after_due_date"] !="":
+                    pd["invalid_after_due_date"]= bool(rec['invalid_after_due_date'])
+            if amount >0:
+                res["payment_data"] = pd
+        except Exception as e:
+            print(str(e))
+    return res
+
+#%%
+def fanout(url, key, content, recipients):
+    # the shared content is serialised once, recipient fields are spliced in
+    # one result per recipient, in order, duplicated fiscal codes are not sent twice
+    hdr = {"Ocp-Apim-Subscription-Key": key, "Content-Type": "application/json"}
+    shared = json.dumps(content)[1:-1]
+    session = requests.Session()
+    seen = set()
+    res = []
+    for rec in recipients:
+        if isinstance(rec, str):
+            rec = {"fiscal_code": rec}
+        dest = rec.get("fiscal_code")
+        if dest in seen:
+            res.append({"fiscal_code": dest, "error": "duplicate fiscal code"})
+            continue
+        seen.add(dest)
+        try:
+            code = dest.split(":")[0]
+            fields = "".join([", %s: %s" % (json.dumps(k), json.dumps(v)) for (k,v) in extra(rec).items()])
+            data = '{"content": {%s%s}, "fiscal_code": %s}' % (shared, fields, json.dumps(code))
+            r = session.post(url, data=data.encode("utf-8"), headers=hdr)
+            if r.status_code == 201:
+                out = json.loads(r.text)
+            else:
+                out = {"error": r.text}
+        except Exception as e:
+            out = {"error": str(e)}
+        out["fiscal_code"] = dest
+        res.append(out)
+    return {"body": {"results": res}}
+
+#%%
+def track(run, results):
+    # aggregate state of a ship run, see util/send
+    # the message is already sent, so a failure here must not turn into an error
+    if not run:
+        return
+    try:
+        from nimbella import redis
+        pipe = redis().pipeline()
+        for (code, res) in results.items():
+            if not isinstance(code, str):
+                continue
+            status = "error" if "error" in res else "ok"
+            pipe.eval(TRACK, 2, "ship:%s" % run, "ship:%s:status" % run, code, status, SHIP_TTL)
+        pipe.execute()
+    except Exception as e:
+        print(str(e))
+
 #%%
 def main(args):
     """
@@ -39,6 +126,19 @@ def main(args):
     >>> args["notice_number"]: "000000000000000001"
     >>> print(len(main(args)['body']['id']))
     26
+    >>> del args['fiscal_code']
+    >>> args['fiscal_codes'] = ["DGRMLL66R65H769R", {"fiscal_code": "DGRMLL66R65H769R", "amount": 1}]
+    >>> del args['subject']
+    >>> print(main(args))
+    {'body': {'error': "missing argument 'subject'"}}
+    >>> args['subject'] = "Welcome new user !"
+    >>> res = main(args)['body']['results']
+    >>> print([r['fiscal_code'] for r in res])
+    ['DGRMLL66R65H769R', 'DGRMLL66R65H769R']
+    >>> print(['error' in r or 'id' in r for r in res])
+    [True, True]
+    >>> print(res[1]['error'])
+    duplicate fiscal code
     >>> #args['io-apikey'] = "c64b38f22e8344a18d63d7c524b171cc"
     >>> #args['fiscal_code'] = "SCCNDR68T05L483L"
     >>> #print(main(args))
@@ -46,6 +146,20 @@ def main(args):
     try:
         url = args['io-messages']
         key = args['io-apikey']
+        if "fiscal_codes" in args:
+            codes = args["fiscal_codes"]
+            if isinstance(codes, str):
+                codes = codes.split(",")
+            content = {
+                "subject": args['subject'],
+                "markdown": args['markdown'],
+            }
+            res = fanout(url, key, content, codes)
+            results = {}
+            for r in res["body"]["results"]:
+                results.setdefault(r["fiscal_code"], r)
+            track(args.get("run"), results)
+            return res
         code = args['fiscal_code'].split(":")[0]
         msg = {
             "content": {
@@ -54,24 +168,10 @@ def main(args):
             },
             "fiscal_code": code
         }
-        if "amount" in args and args["amount"] != "":
-            try:
-                amount = int(args["amount"])
-                pd = {
-                    "amount": amount,
-                    "notice_number": "000000000000000001",
-                }
-                if "notice_number" in args:
-                    pd["notice_number"] = ("000000000000000000" + args["notice_number"])[-18:]
-                if "due_date" in args and args["due_date"] !="" :
-                    msg["content"]["due_date"] = args["due_date"]
-                    if "invalid_after_due_date" in args and args["invalid_after_due_date"] !="":
-                        pd["invalid_after_due_date"]= bool(args['invalid_after_due_date'])
-                if amount >0:
-                    msg["content"]["payment_data"] = pd
-            except Exception as e:
-                print(str(e))
-        return send(url, key, msg)
+        msg["content"].update(extra(args))
+        res = send(url, key, msg)
+        track(args.get("run"), {args['fiscal_code']: res["body"]})
+        return res
     except KeyError as e:
         return { "body": { "error": "missing argument %s" % str(e)}}
     except ValueError as e:
@@ -1,6 +1,61 @@
-import json, os
+import json, os, time
 from nimbella import redis
 
+BATCH_START = 64
+BATCH_MIN = 8
+BATCH_MAX = 4096
+BATCH_BYTES = 1 << 20   # max bytes in flight, request plus expected reply
+BATCH_RTT = 0.05        # target pipeline round trip in seconds
+
+# adapted across warm invocations of the action
+batch_state = {"size": BATCH_START, "reply": 0, "measured": 0}
+
+def pipelined(red, cmds, metrics):
+    # run (command, args) in pipelines sized on the observed round trip
+    # the same helper is in util/store and util/cache, actions are single files
+    res = []
+    size, reply = batch_state["size"], batch_state["reply"]
+    first = True
+    i = 0
+    while i < len(cmds):
+        pipe = red.pipeline()
+        n, nbytes = 0, 0
+        while i < len(cmds) and n < size and nbytes + n*reply < BATCH_BYTES:
+            (cmd, cargs) = cmds[i]
+            getattr(pipe, cmd)(*cargs)
+            nbytes += sum([len(a) if isinstance(a, (str, bytes)) else 8 for a in cargs])
+            n += 1
+            i += 1
+        start = time.time()
+        out = pipe.execute()
+        rtt = time.time() - start
+        res.extend(out)
+        used = size
+        reply = sum([len(r) for r in out if isinstance(r, bytes)]) / n
+        # the first round trip may include the connection setup,
+        # but only trust that for a batch size already measured
+        slow = rtt > BATCH_RTT and not (first and n <= batch_state["measured"])
+        if nbytes + n*reply > BATCH_BYTES or slow:
+            size = max(BATCH_MIN, size // 2)
+        elif rtt < BATCH_RTT / 2 and n == size:
+            # grow only after a full batch was fast
+            size = min(BATCH_MAX, size * 2)
+        first = False
+        # largest batch seen within the target round trip
+        if rtt <= BATCH_RTT:
+            batch_state["measured"] = max(n, batch_state["measured"])
+        elif slow:
+            batch_state["measured"] = min(size, batch_state["measured"])
+        batch_state["size"], batch_state["reply"] = size, reply
+        metrics["batches"] = metrics.get("batches", 0) + 1
+        metrics["batch_size"] = used
+        metrics["next_batch_size"] = size
+        metrics["batch_size_max"] = max(n, metrics.get("batch_size_max", 0))
+        metrics["bytes_max"] = max(nbytes + int(n*reply), metrics.get("bytes_max", 0))
+        metrics["rtt_ms"] = round(rtt * 1000, 2)
+        metrics["reply_avg"] = round(reply, 1)
+    return res
+
 def main(args):
     red =  redis()
     res = {}
@@ -16,16 +71,28 @@ def main(args):
             res["error"] = "cannot set %s to %s" % (k,v)
     elif "get" in args:
         k = args["get"]
-        v = red.get(k)
-        if v:
-            v = json.loads(v.decode("utf-8"))
+        t = red.type(k).decode("utf-8")
+        # ship run state is a redis hash, delta imports use a set
+        if t == "hash":
+            res[k] = {f.decode("utf-8"): n.decode("utf-8") for (f,n) in red.hgetall(k).items()}
+        elif t == "set":
+            res[k] = sorted([i.decode("utf-8") for i in red.smembers(k)])
+        elif t == "string":
+            # content hashes are stored as plain strings, not json
+            v = red.get(k).decode("utf-8")
+            try: v = json.loads(v)
+            except: pass
             try: res[k] = json.loads(v)
             except: res[k] = v
         else:
             res["error"] = "cannot find %s" % k
     elif "del" in args:
         k = args["del"]
-        if red.delete(k):
+        # content hash written by util/store and util/messages
+        pipe = red.pipeline()
+        pipe.delete(k)
+        pipe.delete("hash:%s" % k)
+        if pipe.execute()[0]:
             res["del:%s"%k]=True
         else:
             res["error"] = "cannot delete %s" % k
@@ -38,6 +105,16 @@ def main(args):
            for i in ls:
               out.append(i.decode('utf-8'))
         res["scan"] = out
+    elif "ship" in args:
+        run = args["ship"]
+        v = red.hgetall("ship:%s" % run)
+        count = {"ok": 0, "error": 0}
+        for (f,n) in v.items():
+            count[f.decode("utf-8")] = int(n)
+        res["ship:%s" % run] = count
+        if "code" in args:
+            v = red.hget("ship:%s:status" % run, args["code"])
+            res[args["code"]] = v.decode("utf-8") if v else None
     elif "clean" in args:
         pattern = args["clean"]
         (cur, ls) = red.scan(0, match=pattern)
@@ -46,9 +123,14 @@ def main(args):
            (cur, ls) = red.scan(cur, match=pattern)
            for i in ls:
               out.append(i.decode('utf-8'))
-        res = {}
+        metrics = {}
+        cmds = []
         for i in out:
-            res[i] = red.delete(i) == 1
+            cmds.append(("delete", (i,)))
+            cmds.append(("delete", ("hash:%s" % i,)))
+        found = pipelined(red, cmds, metrics)[::2]
+        res["clean"] = {i: n == 1 for (i, n) in zip(out, found)}
+        res["metrics"] = metrics
     if "__ow_method" in args:
         return { "body": json.dumps(res) }
     return res
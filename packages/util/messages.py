@@ -4,8 +4,13 @@ import os
 import json
 import pip
 import zlib
+import hashlib
 from nimbella import redis
 
+def digest(rec):
+    data = json.dumps(rec, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
 def main(args):
     body = args["__ow_body"]
     if args["__ow_headers"]["content-type"] == "application/json":
@@ -19,10 +24,22 @@ def main(args):
          body.get("content").get("due_date") ):
             code = body["fiscal_code"]
             id = str(zlib.crc32(code.encode("utf-8")))
+            key = "message:%s" % code
+            h = digest(body)
             red = redis()
+            pipe = red.pipeline()
+            pipe.exists(key)
+            pipe.get("hash:%s" % key)
+            [exists, old] = pipe.execute()
+            if exists and old and old.decode("utf-8") == h:
+                return {"body": {"id": id, "status": "unchanged"} }
             data = json.dumps(body).encode("utf-8")
-            red.set("message:%s" % code, data)
-            return {"body": {"id": id} }
+            pipe = red.pipeline()
+            pipe.set(key, data)
+            pipe.set("hash:%s" % key, h)
+            pipe.execute()
+            status = "updated" if exists else "inserted"
+            return {"body": {"id": id, "status": status} }
 
     return { "body": { "detail": "validation errors"}}
 
@@ -6,16 +6,69 @@ import pip
 import zlib
 from nimbella import redis
 
+SHIP_TTL = 7 * 86400    # ship run state expires after a week
+
+# move the recipient from its previous status counter to the new one,
+# so retries do not count twice
+TRACK = """
+local old = redis.call('HGET', KEYS[2], ARGV[1])
+if old ~= ARGV[2] then
+  if old then redis.call('HINCRBY', KEYS[1], old, -1) end
+  redis.call('HINCRBY', KEYS[1], ARGV[2], 1)
+  redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+"""
+
+def track(pipe, run, dest, status):
+    # aggregate state of a ship run, updated with each send result
+    if run:
+        pipe.eval(TRACK, 2, "ship:%s" % run, "ship:%s:status" % run, dest, status, SHIP_TTL)
+
+def fanout(red, subj, mesg, codes, run=None):
+    # the shared content is serialised once, the fiscal code is spliced in
+    shared = json.dumps({"subject": subj, "markdown": mesg})[:-1]
+    seen = set()
+    res = []
+    pipe = red.pipeline()
+    for dest in codes:
+        if dest in seen:
+            res.append({"fiscal_code": dest, "error": "duplicate fiscal code"})
+            continue
+        seen.add(dest)
+        data = '%s, "fiscal_code": %s}' % (shared, json.dumps(dest))
+        pipe.set("sent:%s" % dest, data.encode("utf-8"))
+        track(pipe, run, dest, "ok")
+        res.append({"fiscal_code": dest, "id": str(zlib.crc32(dest.encode("utf-8")))})
+    pipe.execute()
+    return {"results": res}
+
 def main(args):
     dest = args.get("fiscal_code")
+    dests = args.get("fiscal_codes")
     subj = args.get("subject")
-    mesg = args.get("markdown") 
-    if dest and subj and mesg:
+    mesg = args.get("markdown")
+    run = args.get("run")
+    if dests and subj and mesg:
+        if isinstance(dests, str):
+            dests = dests.split(",")
+        dests = [d if isinstance(d, str) else d.get("fiscal_code") for d in dests]
+        if all(dests):
+            return {"body": fanout(redis(), subj, mesg, dests, run) }
+    elif dest and subj and mesg:
         id = str(zlib.crc32(dest.encode("utf-8")))
         red =  redis()
         data = {"subject": subj, "markdown": mesg, "fiscal_code": dest}
         data = json.dumps(data).encode("utf-8")
-        red.set("sent:%s" % dest, data)
+        pipe = red.pipeline()
+        pipe.set("sent:%s" % dest, data)
+        track(pipe, run, dest, "ok")
+        pipe.execute()
         return {"body": {"id": id} }
 
+    if dest and run:
+        pipe = redis().pipeline()
+        track(pipe, run, dest, "error")
+        pipe.execute()
     return { "body": { "detail": "validation errors"}}
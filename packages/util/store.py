@@ -3,8 +3,170 @@ import time
 import os
 import json
 import pip
+import uuid
+import hashlib
 from nimbella import redis
 
+BATCH_START = 64
+BATCH_MIN = 8
+BATCH_MAX = 4096
+BATCH_BYTES = 1 << 20   # max bytes in flight, request plus expected reply
+BATCH_RTT = 0.05        # target pipeline round trip in seconds
+IMPORT_TTL = 86400      # import manifests expire after one day
+
+# adapted across warm invocations of the action
+batch_state = {"size": BATCH_START, "reply": 0, "measured": 0}
+
+def pipelined(red, cmds, metrics):
+    # run (command, args) in pipelines sized on the observed round trip
+    # the same helper is in util/store and util/cache, actions are single files
+    res = []
+    size, reply = batch_state["size"], batch_state["reply"]
+    first = True
+    i = 0
+    while i < len(cmds):
+        pipe = red.pipeline()
+        n, nbytes = 0, 0
+        while i < len(cmds) and n < size and nbytes + n*reply < BATCH_BYTES:
+            (cmd, cargs) = cmds[i]
+            getattr(pipe, cmd)(*cargs)
+            nbytes += sum([len(a) if isinstance(a, (str, bytes)) else 8 for a in cargs])
+            n += 1
+            i += 1
+        start = time.time()
+        out = pipe.execute()
+        rtt = time.time() - start
+        res.extend(out)
+        used = size
+        reply = sum([len(r) for r in out if isinstance(r, bytes)]) / n
+        # the first round trip may include the connection setup,
+        # but only trust that for a batch size already measured
+        slow = rtt > BATCH_RTT and not (first and n <= batch_state["measured"])
+        if nbytes + n*reply > BATCH_BYTES or slow:
+            size = max(BATCH_MIN, size // 2)
+        elif rtt < BATCH_RTT / 2 and n == size:
+            # grow only after a full batch was fast
+            size = min(BATCH_MAX, size * 2)
+        first = False
+        # largest batch seen within the target round trip
+        if rtt <= BATCH_RTT:
+            batch_state["measured"] = max(n, batch_state["measured"])
+        elif slow:
+            batch_state["measured"] = min(size, batch_state["measured"])
+        batch_state["size"], batch_state["reply"] = size, reply
+        metrics["batches"] = metrics.get("batches", 0) + 1
+        metrics["batch_size"] = used
+        metrics["next_batch_size"] = size
+        metrics["batch_size_max"] = max(n, metrics.get("batch_size_max", 0))
+        metrics["bytes_max"] = max(nbytes + int(n*reply), metrics.get("bytes_max", 0))
+        metrics["rtt_ms"] = round(rtt * 1000, 2)
+        metrics["reply_avg"] = round(reply, 1)
+    return res
+
+def digest(rec):
+    data = json.dumps(rec, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+def lookup(red, keys, metrics):
+    # lookup stored hashes, pipelined
+    cmds = []
+    for k in keys:
+        cmds.append(("exists", (k,)))
+        cmds.append(("get", ("hash:%s" % k,)))
+    found = pipelined(red, cmds, metrics)
+    res = []
+    for i in range(len(keys)):
+        old = found[2*i+1]
+        res.append((found[2*i], old.decode("utf-8") if old else None))
+    return res
+
+def manifest(red, batch, hashes, count, missing):
+    # the rows still to upload are a set, so concurrent uploads can SREM them
+    data = {
+        "batch": batch,
+        "time": int(time.time()),
+        "count": len(hashes),
+        "hashes": hashes
+    }
+    data.update(count)
+    pipe = red.pipeline()
+    pipe.set("import:%s" % batch, json.dumps(data).encode("utf-8"), ex=IMPORT_TTL)
+    if missing:
+        pipe.sadd("import:%s:missing" % batch, *missing)
+        pipe.expire("import:%s:missing" % batch, IMPORT_TTL)
+    pipe.execute()
+
+def delta(red, hashes, metrics):
+    # the client sends only the hashes, we answer with the rows to upload
+    codes = list(hashes.keys())
+    found = lookup(red, ["message:%s" % c for c in codes], metrics)
+    count = {"inserted": 0, "updated": 0, "unchanged": 0}
+    missing = []
+    for (c, (exists, old)) in zip(codes, found):
+        if exists and old == hashes[c]:
+            count["unchanged"] += 1
+            continue
+        count["updated" if exists else "inserted"] += 1
+        missing.append(c)
+    batch = uuid.uuid4().hex
+    manifest(red, batch, hashes, count, missing)
+    res = {"batch": batch, "missing": missing}
+    res.update(count)
+    return res
+
+def store(red, records, metrics):
+    data = [ ("message:%s" % m["fiscal_code"], m, digest(m))  for m in records ]
+    found = lookup(red, [k for (k,v,h) in data], metrics)
+
+    # write only new or changed records
+    res = {}
+    count = {"inserted": 0, "updated": 0, "unchanged": 0}
+    written = []
+    cmds = []
+    for ((k,v,h), (exists, old)) in zip(data, found):
+        if exists and old == h:
+            count["unchanged"] += 1
+            res[k] = True
+            continue
+        count["updated" if exists else "inserted"] += 1
+        written.append(k)
+        cmds.append(("set", (k, json.dumps(v).encode("utf-8"))))
+        cmds.append(("set", ("hash:%s" % k, h)))
+    for (k,ok) in zip(written, pipelined(red, cmds, metrics)[::2]):
+        res[k] = ok
+    return res, count, { m["fiscal_code"]: h for (k,m,h) in data }
+
+def upload(red, batch, records, metrics):
+    # rows requested by a delta import, checked against its manifest
+    v = red.get("import:%s" % batch)
+    if not v:
+        return {"error": "unknown batch %s" % batch}
+    data = json.loads(v.decode("utf-8"))
+    key = "import:%s:missing" % batch
+    pipe = red.pipeline()
+    for m in records:
+        pipe.sismember(key, m.get("fiscal_code") or "")
+    found = pipe.execute()
+    accepted, rejected, seen = [], [], set()
+    for (m, missing) in zip(records, found):
+        code = m.get("fiscal_code")
+        if missing and code not in seen and data["hashes"].get(code) == digest(m):
+            seen.add(code)
+            accepted.append(m)
+        else:
+            rejected.append(code)
+    res, count, hashes = store(red, accepted, metrics)
+    pipe = red.pipeline()
+    for code in hashes:
+        pipe.srem(key, code)
+    pipe.scard(key)
+    pending = pipe.execute()[-1]
+    res.update(count)
+    res["batch"] = batch
+    res["rejected"] = rejected
+    res["pending"] = pending
+    return res
+
 def main(args):
     red =  redis()
     body = args["__ow_body"]
@@ -12,9 +174,18 @@ def main(args):
         body = base64.b64decode(body).decode("utf-8")
     body = json.loads(body)
     # with open("import.json", "r") as f: body = json.loads(f.read())
-    data = [ ("message:%s" % m["fiscal_code"], m)  for m in body["data"] ]
-    res = {}
-    for (k,v) in data:
-        v = json.dumps(v).encode("utf-8")
-        res[k] = red.set(k,v)
+    metrics = {}
+    if "hashes" in body:
+        res = delta(red, body["hashes"], metrics)
+        res["metrics"] = metrics
+        return { "body": res }
+    if "batch" in body:
+        res = upload(red, body["batch"], body["data"], metrics)
+        res["metrics"] = metrics
+        return { "body": res }
+    res, count, hashes = store(red, body["data"], metrics)
+    res.update(count)
+    res["metrics"] = metrics
+    res["batch"] = uuid.uuid4().hex
+    manifest(red, res["batch"], hashes, count, [])
     return { "body": res }
@@ -11,3 +11,15 @@ load util
     run wsk action invoke util/cache -r -p get pippo
     ckline '"error": "cannot find pippo"'
 }
+
+@test "cache ship status" {
+    run wsk action invoke util/cache -r -p ship nosuchrun
+    ckline '"ok": 0'
+}
+
+@test "cache clean" {
+    run wsk action invoke util/cache -r -p set cleantest=1
+    run wsk action invoke util/cache -r -p clean "cleantest"
+    ckline '"cleantest": true'
+    ckline '"batch_size":'
+}
@@ -8,4 +8,6 @@ load util
     ckline "id"
     run wsk action invoke util/cache -r -p get message:1234567890123456
     ckline '"fiscal_code": "1234567890123456"'
+    post $URL/util/messages <"$H/messages.json"
+    ckline '"status": "unchanged"'
 }
@@ -18,3 +18,35 @@ load util
 EOF
 }
 
+@test "send fan-out" {
+    fpost $URL/util/send fiscal_codes=SNDMSGTEST1235,SNDMSGTEST1236,SNDMSGTEST1235 subject=Hello markdown=World
+    ckline '"fiscal_code": "SNDMSGTEST1236",'
+    ckline '"error": "duplicate fiscal code",'
+    run wsk action invoke util/cache -p get "sent:SNDMSGTEST1235" -r
+    ckdiff <<EOF
+{
+    "sent:SNDMSGTEST1235": {
+        "fiscal_code": "SNDMSGTEST1235",
+        "markdown": "World",
+        "subject": "Hello"
+    }
+}
+EOF
+}
+
+@test "send progress" {
+    fpost $URL/util/send fiscal_code=SNDMSGTEST1237 subject=Hello markdown=World run=batstest
+    ckline '"id":'
+    ipost $URL/util/send fiscal_code=SNDMSGTEST1238 run=batstest
+    ckline "validation errors"
+    fpost $URL/util/send fiscal_code=SNDMSGTEST1238 subject=Hello markdown=World run=batstest
+    ckline '"id":'
+    run wsk action invoke util/cache -p ship batstest -p code SNDMSGTEST1238 -r
+    ckline '"error": 0'
+    ckline '"ok": 2'
+    ckline '"SNDMSGTEST1238": "ok"'
+    run wsk action invoke util/cache -p get "ship:batstest" -r
+    ckline '"ok": "2"'
+    run wsk action invoke util/cache -p del "ship:batstest" -r
+    run wsk action invoke util/cache -p del "ship:batstest:status" -r
+}
@@ -6,4 +6,49 @@ load util
     ckline '"message:ISPXNB32R82Y766D": true,'
     run wsk action invoke util/cache -r -p scan "*"
     ckline '"message:ISPXNB32R82Y766D"'
+    post $URL/util/store <"$H/import.json"
+    ckline '"message:ISPXNB32R82Y766D": true,'
+    ckline '"unchanged": 2'
+    ckline '"batch_size":'
+}
+
+@test "store delta" {
+    post $URL/util/store <"$H/import.json"
+    ckline '"batch":'
+    ijpost $URL/util/store hashes:='{"ISPXNB32R82Y766D": "0000"}'
+    ckline '"missing": ['
+    ckline '"ISPXNB32R82Y766D"'
+    ckline '"updated": 1'
+    ijpost $URL/util/store batch=nosuchbatch data:='[]'
+    ckline '"error": "unknown batch nosuchbatch"'
+}
+
+@test "store hash removed with message" {
+    post $URL/util/store <"$H/import.json"
+    run wsk action invoke util/cache -r -p get "hash:message:ISPXNB32R82Y766F"
+    ckline '"hash:message:ISPXNB32R82Y766F": "'
+    run wsk action invoke util/cache -r -p del "message:ISPXNB32R82Y766F"
+    ckline '"del:message:ISPXNB32R82Y766F": true'
+    run wsk action invoke util/cache -r -p get "hash:message:ISPXNB32R82Y766F"
+    ckline '"error": "cannot find hash:message:ISPXNB32R82Y766F"'
+}
+
+@test "store delta upload" {
+    run wsk action invoke util/cache -r -p del "message:DLTUPLTEST1234"
+    row='{"fiscal_code":"DLTUPLTEST1234","markdown":"World","subject":"Hello"}'
+    changed='{"fiscal_code":"DLTUPLTEST1234","markdown":"World","subject":"Changed"}'
+    hash=$(echo -n "$row" | sha1sum | cut -d' ' -f1)
+    ijpost $URL/util/store hashes:="{\"DLTUPLTEST1234\": \"$hash\"}"
+    ckline '"DLTUPLTEST1234"'
+    batch=$(filter sed -n 's/.*"batch": "\([0-9a-f]*\)".*/\1/p')
+    [ -n "$batch" ]
+    ijpost $URL/util/store batch=$batch data:="[$row, $changed]"
+    ckline '"message:DLTUPLTEST1234": true'
+    ckline '"pending": 0'
+    ckline '"rejected": ['
+    ckline '"DLTUPLTEST1234"'
+    ijpost $URL/util/store batch=$batch data:="[$row]"
+    ckline '"pending": 0'
+    ckline '"inserted": 0'
+    run wsk action invoke util/cache -r -p del "message:DLTUPLTEST1234"
 }
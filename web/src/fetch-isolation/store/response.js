@@ -1,3 +1,14 @@
 export const storeResponse = {
-    "message:AAAAAA00A00A000A:1": true
-  };
\ No newline at end of file
+    "message:AAAAAA00A00A000A:1": true,
+    "inserted": 1,
+    "updated": 0,
+    "unchanged": 0
+  };
+
+export const storeDeltaResponse = {
+    "batch": "6f1ed002ab5595859014ebf0951522d9",
+    "missing": ["AAAAAA00A00A000A:1"],
+    "inserted": 1,
+    "updated": 0,
+    "unchanged": 0
+  };
@@ -1,7 +1,7 @@
 import App from './App.svelte';
 import { importResponse, importPostResponse } from './fetch-isolation/import/response';
 import { uploadResponse } from './fetch-isolation/upload/response';
-import { storeResponse } from './fetch-isolation/store/response';
+import { storeResponse, storeDeltaResponse } from './fetch-isolation/store/response';
 import { cacheResponse, getMessageResponse, deleteMessageResponse } from './fetch-isolation/cache/response';
 import { sendResponse, sendSingleMessageResponse } from './fetch-isolation/send/response';
 
@@ -21,7 +21,8 @@ createServer({
         // click button Import in import URL
         this.post("/api/v1/web/guest/util/upload", () => uploadResponse)
         this.post("/api/v1/web/guest/util/import", () => importPostResponse)
-        this.post("/api/v1/web/guest/util/store", () => storeResponse)
+        this.post("/api/v1/web/guest/util/store", (schema, request) =>
+          "hashes" in JSON.parse(request.requestBody) ? storeDeltaResponse : storeResponse)
         // click link Send Messages
         this.get("/api/v1/web/guest/util/cache?scan=message:*", () => cacheResponse)
         // select messages and click on Send button